@@ -1,25 +1,28 @@
 import gc
 import hashlib
 import logging
-import math
 import os
 import random
+import re
 import subprocess
 import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from os.path import expanduser
 from pathlib import Path
 from types import SimpleNamespace
+from weakref import WeakKeyDictionary
 from typing import Dict, Union, Any, List, overload, Optional
 
-import lpips
 import numpy as np
 import torch
 from IPython import display
-from PIL import ImageOps
 from docarray import Document
 from ipywidgets import Output
 from torch import Tensor, nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from torchvision import transforms as T
 from torchvision.transforms import functional as TF
 
@@ -42,6 +45,13 @@ device = torch.device('cuda:0')
 
 _clip_models_cache = {}
 
+_text_embeds_cache = WeakKeyDictionary()
+
+_cutouts_cache = {}
+
+_CLIP_MEAN = torch.tensor([0.48145466, 0.4578275, 0.40821073]).view(1, 3, 1, 1)
+_CLIP_STD = torch.tensor([0.26862954, 0.26130258, 0.27577711]).view(1, 3, 1, 1)
+
 
 def _get_logger():
     logger = logging.getLogger(__package__)
@@ -104,6 +114,18 @@ def _clone_dependencies():
     )
 
 
+def _sha256sum(path: str) -> str:
+    # stream the file through the digest so checking a multi-GB checkpoint
+    # does not hold the whole file in memory
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+        return h.hexdigest()
+
+
 def _wget(url, outputdir):
     res = subprocess.run(
         ['wget', url, '-q', '-P', f'{outputdir}'], stdout=subprocess.PIPE
@@ -112,7 +134,9 @@ def _wget(url, outputdir):
 
 
 def load_clip_models(device, enabled: List[str], clip_models: Dict[str, Any] = {}):
-    # load enabled models
+    # load enabled models; on CUDA `clip.load` already applies
+    # `convert_weights` so conv/linear/attention weights are fp16 while
+    # LayerNorm stays fp32 for its upcast path -- do not blanket-`.half()`
     for k in enabled:
         if k not in clip_models:
             clip_models[k] = clip.load(k, jit=False)[0].eval().requires_grad_(False).to(device)
@@ -136,9 +160,7 @@ def load_all_models(
 
     if os.path.exists(model_512_path) and check_model_SHA:
         logger.debug('Checking 512 Diffusion File')
-        with open(model_512_path, "rb") as f:
-            bytes = f.read()
-            hash = hashlib.sha256(bytes).hexdigest()
+        hash = _sha256sum(model_512_path)
         if hash == model_512_SHA:
             logger.debug('512 Model SHA matches')
             model_512_downloaded = True
@@ -175,7 +197,7 @@ def load_all_models(
 model_config = load_all_models()
 
 
-def load_diffusion_model(model_config, steps, device):
+def load_diffusion_model(model_config, steps, device, training: bool = False):
 
     timestep_respacing = f'ddim{steps}'
     diffusion_steps = (1000 // steps) * steps if steps < 1000 else steps
@@ -191,15 +213,74 @@ def load_diffusion_model(model_config, steps, device):
         torch.load(f'{cache_dir}/512x512_diffusion_uncond_finetune_008100.pt', map_location='cpu')
     )
     model.requires_grad_(False).eval().to(device)
-    for name, param in model.named_parameters():
-        if 'qkv' in name or 'norm' in name or 'proj' in name:
-            param.requires_grad_()
+    if training:
+        # only finetuning needs grads on the attention/norm weights; during
+        # sampling they would just bloat the autograd tape of every step
+        for name, param in model.named_parameters():
+            if 'qkv' in name or 'norm' in name or 'proj' in name:
+                param.requires_grad_()
     if model_config['use_fp16']:
         model.convert_to_fp16()
 
+    # NHWC is the fast path for fp16 convs on Ampere+; convert before compile
+    model = model.to(memory_format=torch.channels_last)
+
+    if hasattr(torch, 'compile'):
+        # shapes are fixed per `create` call, so static compilation with
+        # cuda-graph reuse pays off over the hundreds of U-Net forwards
+        model = torch.compile(
+            model, mode='reduce-overhead', fullgraph=False, dynamic=False
+        )
+
     return model, diffusion
 
 
+_schedule_term = re.compile(
+    r'\s*\[\s*(\d+(?:\.\d+)?(?:\s*,\s*\d+(?:\.\d+)?)*)\s*\](?:\s*\*\s*(\d+))?\s*'
+)
+
+
+@lru_cache(maxsize=None)
+def _parse_schedule(s: str) -> tuple:
+    """Parse a cutout schedule such as ``[12]*400+[4]*600`` without ``eval``.
+
+    The grammar is ``[v, ...]*n`` terms joined by ``+``; anything else raises
+    `ValueError` at parse time, like the old ``eval`` raised `SyntaxError`.
+    """
+    schedule = []
+    pos = 0
+    while True:
+        m = _schedule_term.match(s, pos)
+        if not m:
+            raise ValueError(
+                f'can not parse the cut schedule {s!r} at position {pos}'
+            )
+        values = [float(v) for v in m.group(1).split(',')]
+        values = [int(v) if v.is_integer() else v for v in values]
+        schedule.extend(values * int(m.group(2) or 1))
+        pos = m.end()
+        if pos == len(s):
+            return tuple(schedule)
+        if s[pos] != '+':
+            raise ValueError(
+                f'can not parse the cut schedule {s!r} at position {pos}'
+            )
+        pos += 1
+
+
+def _encode_text_cached(clip_model, txt: str) -> Tensor:
+    # text embeddings are invariant across diffusion steps and `create` calls,
+    # so encode each (model, text) pair only once; stored pre-normalized so
+    # spherical_dist_loss can skip normalizing the target side. Weakly keyed
+    # by the model itself so entries die with it and can never alias a model
+    # loaded later
+    per_model = _text_embeds_cache.setdefault(clip_model, {})
+    if txt not in per_model:
+        embed = clip_model.encode_text(clip.tokenize(txt).to(device)).float()
+        per_model[txt] = F.normalize(embed, dim=-1)
+    return per_model[txt]
+
+
 def parse_prompt(prompt):
     if prompt.startswith('http://') or prompt.startswith('https://'):
         vals = prompt.rsplit(':', 2)
@@ -256,24 +337,23 @@ def create(**kwargs):
         display.clear_output(wait=True)
 
 
-def sinc(x):
-    return torch.where(x != 0, torch.sin(math.pi * x) / (math.pi * x), x.new_ones([]))
-
+class _AddNoise(nn.Module):
+    # scriptable stand-in for the old `T.Lambda(lambda x: x + randn * 0.01)`
+    def __init__(self, std: float):
+        super().__init__()
+        self.std = std
 
-def lanczos(x, a):
-    cond = torch.logical_and(-a < x, x < a)
-    out = torch.where(cond, sinc(x) * sinc(x / a), x.new_zeros([]))
-    return out / out.sum()
+    def forward(self, x):
+        return x + torch.randn_like(x) * self.std
 
 
-def ramp(ratio, width):
-    n = math.ceil(width / ratio + 1)
-    out = torch.empty([n])
-    cur = 0
-    for i in range(out.shape[0]):
-        out[i] = cur
-        cur += ratio
-    return torch.cat([-out[1:].flip([0]), out])[1:-1]
+def _scripted_augs(*augs: nn.Module) -> nn.Module:
+    seq = nn.Sequential(*augs)
+    try:
+        return torch.jit.script(seq)
+    except Exception as ex:
+        logger.debug(f'cannot script augmentations, fallback to eager mode: {ex}')
+        return seq
 
 
 class MakeCutouts(nn.Module):
@@ -282,18 +362,14 @@ class MakeCutouts(nn.Module):
         self.cut_size = cut_size
         self.cutn = cutn
         self.skip_augs = skip_augs
-        self.augs = T.Compose(
-            [
-                T.RandomHorizontalFlip(p=0.5),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomAffine(degrees=15, translate=(0.1, 0.1)),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomPerspective(distortion_scale=0.4, p=0.7),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomGrayscale(p=0.15),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                # T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
-            ]
+        self.augs = _scripted_augs(
+            T.RandomHorizontalFlip(p=0.5),
+            # one noise add with the variance of the four 0.01-std adds it fuses
+            _AddNoise(std=0.02),
+            T.RandomAffine(degrees=15, translate=(0.1, 0.1)),
+            T.RandomPerspective(distortion_scale=0.4, p=0.7),
+            T.RandomGrayscale(p=0.15),
+            # T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
         )
 
     def forward(self, input):
@@ -337,38 +413,36 @@ class MakeCutoutsDango(nn.Module):
         self.InnerCrop = InnerCrop
         self.IC_Size_Pow = IC_Size_Pow
         self.IC_Grey_P = IC_Grey_P
-        self.augs = T.Compose(
-            [
-                T.RandomHorizontalFlip(p=0.5),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomAffine(
-                    degrees=10,
-                    translate=(0.05, 0.05),
-                    interpolation=T.InterpolationMode.BILINEAR,
-                ),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.RandomGrayscale(p=0.1),
-                T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
-                T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
-            ]
+        self.gray = T.Grayscale(3)
+        self.augs = _scripted_augs(
+            T.RandomHorizontalFlip(p=0.5),
+            # one noise add with the variance of the three 0.01-std adds it fuses
+            _AddNoise(std=0.01 * 3 ** 0.5),
+            T.RandomAffine(
+                degrees=10,
+                translate=(0.05, 0.05),
+                interpolation=T.InterpolationMode.BILINEAR,
+            ),
+            T.RandomGrayscale(p=0.1),
+            T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
         )
 
     def forward(self, input):
         cutouts = []
-        gray = T.Grayscale(3)
+        gray = self.gray
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
         output_shape = [1, 3, self.cut_size, self.cut_size]
+        pad_w = (sideY - max_size) // 2
+        pad_h = (sideX - max_size) // 2
+        # reflect padding requires pad < dim, which a >= 3:1 canvas exceeds;
+        # fall back to replicate there instead of crashing
+        pad_mode = 'reflect' if pad_w < sideX and pad_h < sideY else 'replicate'
         pad_input = F.pad(
             input,
-            (
-                (sideY - max_size) // 2,
-                (sideY - max_size) // 2,
-                (sideX - max_size) // 2,
-                (sideX - max_size) // 2,
-            ),
-            **padargs,
+            (pad_w, pad_w, pad_h, pad_h),
+            mode=pad_mode,
         )
         cutout = resize(pad_input, out_shape=output_shape)
 
@@ -409,45 +483,25 @@ class MakeCutoutsDango(nn.Module):
 
 
 def resample(input, size, align_corners=True):
-    n, c, h, w = input.shape
-    dh, dw = size
-
-    input = input.reshape([n * c, 1, h, w])
-
-    if dh < h:
-        kernel_h = lanczos(ramp(dh / h, 2), 2).to(input.device, input.dtype)
-        pad_h = (kernel_h.shape[0] - 1) // 2
-        input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
-        input = F.conv2d(input, kernel_h[None, None, :, None])
-
-    if dw < w:
-        kernel_w = lanczos(ramp(dw / w, 2), 2).to(input.device, input.dtype)
-        pad_w = (kernel_w.shape[0] - 1) // 2
-        input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
-        input = F.conv2d(input, kernel_w[None, None, None, :])
-
-    input = input.reshape([n, c, h, w])
-    return F.interpolate(input, size, mode='bicubic', align_corners=align_corners)
-
-
-padargs = {}
+    # antialiased bicubic does the separable low-pass + resize in one fused
+    # kernel, replacing the old Lanczos-via-conv2d prefilter
+    return F.interpolate(
+        input, size, mode='bicubic', align_corners=align_corners, antialias=True
+    )
 
 
 def do_run(args, models, device):
     _set_seed(args.seed)
     logger.info('preparing models...')
     model, diffusion, clip_models = models
-    normalize = T.Normalize(
-        mean=[0.48145466, 0.4578275, 0.40821073],
-        std=[0.26862954, 0.26130258, 0.27577711],
-    )
-    lpips_model = lpips.LPIPS(net='vgg').to(device)
+    clip_mean = _CLIP_MEAN.to(device)
+    clip_std = _CLIP_STD.to(device)
 
     side_x = (args.width_height[0] // 64) * 64
     side_y = (args.width_height[1] // 64) * 64
-    cut_overview = eval(args.cut_overview)
-    cut_innercut = eval(args.cut_innercut)
-    cut_icgray_p = eval(args.cut_icgray_p)
+    cut_overview = _parse_schedule(args.cut_overview)
+    cut_innercut = _parse_schedule(args.cut_innercut)
+    cut_icgray_p = _parse_schedule(args.cut_icgray_p)
 
     def interp(t):
         return 3 * t ** 2 - 2 * t ** 3
@@ -484,13 +538,16 @@ def do_run(args, models, device):
         out = perlin_ms(octaves, width, height, grayscale, device)
         if grayscale:
             out = TF.resize(size=(side_y, side_x), img=out.unsqueeze(0))
-            out = TF.to_pil_image(out.clamp(0, 1)).convert('RGB')
+            out = out.expand(3, -1, -1)
         else:
             out = out.reshape(-1, 3, out.shape[0] // 3, out.shape[1])
             out = TF.resize(size=(side_y, side_x), img=out)
-            out = TF.to_pil_image(out.clamp(0, 1).squeeze())
+            out = out.squeeze(0)
 
-        out = ImageOps.autocontrast(out)
+        # tensor-only autocontrast, keeps the init on the GPU instead of
+        # round-tripping through PIL
+        out = out.clamp(0, 1)
+        out = (out - out.amin()) / (out.amax() - out.amin() + 1e-8)
         return out
 
     def regen_perlin(perlin_mode, side_y, side_x, device, batch_size):
@@ -516,15 +573,8 @@ def do_run(args, models, device):
                 [1.5 ** -i * 0.5 for i in range(8)], 4, 4, True, side_y, side_x, device
             )
 
-        init = (
-            TF.to_tensor(init)
-            .add(TF.to_tensor(init2))
-            .div(2)
-            .to(device)
-            .unsqueeze(0)
-            .mul(2)
-            .sub(1)
-        )
+        # both noises are already tensors on `device`
+        init = init.add(init2).div(2).unsqueeze(0).mul(2).sub(1)
         del init2
         return init.expand(batch_size, -1, -1, -1)
 
@@ -544,8 +594,7 @@ def do_run(args, models, device):
 
         for prompt in args.text_prompts:
             txt, weight = parse_prompt(prompt)
-            txt = clip_model.encode_text(clip.tokenize(prompt).to(device)).float()
-            model_stat['target_embeds'].append(txt)
+            model_stat['target_embeds'].append(_encode_text_cached(clip_model, txt))
             model_stat['weights'].append(weight)
 
         model_stat['target_embeds'] = torch.cat(model_stat['target_embeds'])
@@ -555,29 +604,47 @@ def do_run(args, models, device):
         model_stat['weights'] /= model_stat['weights'].sum().abs()
         model_stats.append(model_stat)
 
+    # group clip models by input resolution: cutout generation is identical
+    # within a group, so it only needs to run once per resolution per step
+    model_groups = defaultdict(list)
+    for model_stat in model_stats:
+        # when using SLIP Base model the dimensions need to be hard coded to avoid AttributeError:
+        # 'VisionTransformer' object has no attribute 'input_resolution'
+        try:
+            input_resolution = model_stat['clip_model'].visual.input_resolution
+        except:
+            input_resolution = 224
+        model_groups[input_resolution].append(model_stat)
+
     init = None
 
     cur_t = None
 
     def spherical_dist_loss(x, y):
+        # `y` (target_embeds) is already normalized by `_encode_text_cached`;
+        # with unit vectors ||x-y|| = 2*sin(theta/2), so the old
+        # 2*arcsin(||x-y||/2)^2 equals theta^2/2 with theta = arccos(x.y)
         x = F.normalize(x, dim=-1)
-        y = F.normalize(y, dim=-1)
-        return (x - y).norm(dim=-1).div(2).arcsin().pow(2).mul(2)
+        cos = (x * y).sum(-1).clamp(-1, 1)
+        return cos.arccos().pow(2).div(2)
 
     def tv_loss(input):
         """L2 total variation loss, as in Mahendran et al."""
-        input = F.pad(input, (0, 1, 0, 1), 'replicate')
-        x_diff = input[..., :-1, 1:] - input[..., :-1, :-1]
-        y_diff = input[..., 1:, :-1] - input[..., :-1, :-1]
-        return (x_diff ** 2 + y_diff ** 2).mean([1, 2, 3])
+        # the replicate-pad of the old formulation only added zero diffs at
+        # the border, so plain strided diffs are equivalent
+        x_diff = torch.diff(input, dim=-1)
+        y_diff = torch.diff(input, dim=-2)
+        return x_diff.pow(2).mean([1, 2, 3]) + y_diff.pow(2).mean([1, 2, 3])
 
     def range_loss(input):
         return (input - input.clamp(-1, 1)).pow(2).mean([1, 2, 3])
 
     def cond_fn(x, t, y=None):
-        with torch.enable_grad():
+        with torch.enable_grad(), torch.autocast(
+                device_type='cuda', dtype=torch.float16, enabled=device.type == 'cuda'
+        ):
             x_is_NaN = False
-            x = x.detach().requires_grad_()
+            x = x.detach().contiguous(memory_format=torch.channels_last).requires_grad_()
             n = x.shape[0]
             my_t = torch.ones([n], device=device, dtype=torch.long) * cur_t
             out = diffusion.p_mean_variance(
@@ -586,52 +653,66 @@ def do_run(args, models, device):
             fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
             x_in = out['pred_xstart'] * fac + x * (1 - fac)
             x_in_grad = torch.zeros_like(x_in)
-            for model_stat in model_stats:
-                for i in range(args.cutn_batches):
-                    t_int = (
-                            int(t.item()) + 1
-                    )  # errors on last step without +1, need to find source
-                    # when using SLIP Base model the dimensions need to be hard coded to avoid AttributeError:
-                    # 'VisionTransformer' object has no attribute 'input_resolution'
-                    try:
-                        input_resolution = model_stat[
-                            'clip_model'
-                        ].visual.input_resolution
-                    except:
-                        input_resolution = 224
-
-                    cuts = MakeCutoutsDango(
+            t_int = (
+                    int(t.item()) + 1
+            )  # errors on last step without +1, need to find source
+            step_idx = 1000 - t_int
+            ov, ic, gp = (
+                cut_overview[step_idx],
+                cut_innercut[step_idx],
+                cut_icgray_p[step_idx],
+            )
+            for input_resolution, group in model_groups.items():
+                # only a handful of distinct cutout configs occur over a full
+                # run, so reuse modules instead of rebuilding the T.Compose
+                # pipeline every step
+                cuts_key = (input_resolution, ov, ic, args.cut_ic_pow, gp)
+                if cuts_key not in _cutouts_cache:
+                    _cutouts_cache[cuts_key] = MakeCutoutsDango(
                         input_resolution,
-                        Overview=cut_overview[1000 - t_int],
-                        InnerCrop=cut_innercut[1000 - t_int],
+                        Overview=ov,
+                        InnerCrop=ic,
                         IC_Size_Pow=args.cut_ic_pow,
-                        IC_Grey_P=cut_icgray_p[1000 - t_int],
+                        IC_Grey_P=gp,
                     )
-                    clip_in = normalize(cuts(x_in.add(1).div(2)))
-                    image_embeds = (
-                        model_stat['clip_model'].encode_image(clip_in).float()
+                cuts = _cutouts_cache[cuts_key]
+
+                # build all cutout batches first, then encode them in a single
+                # forward pass instead of `cutn_batches` small ones; the same
+                # cutouts feed every clip model in this resolution group
+                clip_in_all = []
+                for i in range(args.cutn_batches):
+                    clip_in_all.append(
+                        (cuts(x_in.add(1).div(2)) - clip_mean) / clip_std
                     )
+                clip_in_all = torch.cat(clip_in_all, dim=0)
+
+                # the cutout graph is shared by every model in the group, so
+                # sum their losses and backprop through it once
+                group_loss = 0
+                for model_stat in group:
+                    # checkpoint the ViT forward: activations for every cutout
+                    # are what dominates VRAM here, recomputing them on
+                    # backward is the cheaper side of the trade
+                    image_embeds = checkpoint(
+                        model_stat['clip_model'].encode_image,
+                        clip_in_all,
+                        use_reentrant=False,
+                    ).float()
                     dists = spherical_dist_loss(
                         image_embeds.unsqueeze(1),
                         model_stat['target_embeds'].unsqueeze(0),
                     )
-                    dists = dists.view(
-                        [
-                            cut_overview[1000 - t_int] + cut_innercut[1000 - t_int],
-                            n,
-                            -1,
-                        ]
-                    )
+                    dists = dists.view([args.cutn_batches * (ov + ic), n, -1])
+                    # `mean(0)` over all cutouts equals the old per-batch mean
+                    # divided by `cutn_batches`, so one grad call is sufficient
                     losses = dists.mul(model_stat['weights']).sum(2).mean(0)
-                    loss_values.append(
-                        losses.sum().item()
-                    )  # log loss, probably shouldn't do per cutn_batch
-                    x_in_grad += (
-                            torch.autograd.grad(
-                                losses.sum() * args.clip_guidance_scale, x_in
-                            )[0]
-                            / args.cutn_batches
-                    )
+                    loss_values.append(losses.sum().item())
+                    group_loss = group_loss + losses.sum() * args.clip_guidance_scale
+
+                g = torch.autograd.grad(group_loss, x_in)[0]
+                x_in_grad.add_(g)
+                del g
             tv_losses = tv_loss(x_in)
             range_losses = range_loss(out['pred_xstart'])
             sat_losses = torch.abs(x_in - x_in.clamp(min=-1, max=1)).mean()
@@ -640,7 +721,9 @@ def do_run(args, models, device):
                     + range_losses.sum() * args.range_scale
                     + sat_losses.sum() * args.sat_scale
             )
-            x_in_grad += torch.autograd.grad(loss, x_in)[0]
+            g = torch.autograd.grad(loss, x_in)[0]
+            x_in_grad.add_(g)
+            del g
             if not torch.isnan(x_in_grad).any():
                 grad = -torch.autograd.grad(x_in, x, x_in_grad)[0]
             else:
@@ -662,6 +745,21 @@ def do_run(args, models, device):
 
     image_display = Output()
 
+    # a single worker keeps chunks in step order while the datauri encoding
+    # and sprite plotting overlap with the next diffusion step
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def _save_and_plot(image, d, cur_t, _nb):
+        c = Document(tags={'cur_t': cur_t})
+        c.load_pil_image_to_datauri(image)
+        d.chunks.append(c)
+        d.chunks.plot_image_sprites(
+            f'{args.name_docarray}-progress-{_nb}.png',
+            skip_empty=True,
+            show_index=True,
+            keep_aspect_ratio=True,
+        )
+
     org_seed = args.seed
     for _nb in range(args.batch_size):
 
@@ -682,7 +780,7 @@ def do_run(args, models, device):
         if args.perlin_init:
             init = regen_perlin(
                 args.perlin_mode, args.side_y, side_x, device, args.batch_size
-            )
+            ).contiguous(memory_format=torch.channels_last)
 
         if args.diffusion_sampling_mode == 'ddim':
             samples = sample_fn(
@@ -718,20 +816,16 @@ def do_run(args, models, device):
                 if j % args.display_rate == 0 or cur_t == -1:
                     for _, image in enumerate(sample['pred_xstart']):
                         image = TF.to_pil_image(image.add(1).div(2).clamp(0, 1))
-                        c = Document(tags={'cur_t': cur_t})
-                        c.load_pil_image_to_datauri(image)
-                        d.chunks.append(c)
                         display.clear_output(wait=True)
                         display.display(image)
-                        d.chunks.plot_image_sprites(
-                            f'{args.name_docarray}-progress-{_nb}.png',
-                            skip_empty=True,
-                            show_index=True,
-                            keep_aspect_ratio=True,
+                        threads.append(
+                            executor.submit(_save_and_plot, image, d, cur_t, _nb)
                         )
 
         for t in threads:
-            t.join()
+            t.result()
+
+    executor.shutdown(wait=True)
     display.clear_output(wait=True)
 
 
@@ -740,4 +834,8 @@ def _set_seed(seed: int) -> None:
     random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.deterministic = True
+    if os.environ.get('DISCOART_DETERMINISTIC'):
+        torch.backends.cudnn.deterministic = True
+    else:
+        # let cudnn autotune conv kernels; shapes are fixed within a run
+        torch.backends.cudnn.benchmark = True
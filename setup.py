@@ -41,7 +41,6 @@ setup(
     setup_requires=['setuptools>=18.0', 'wheel'],
     install_requires=[
         'numpy',
-        'lpips',
         'ftfy',
         'docarray[common]>=0.13.30',
         'pyyaml',